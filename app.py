@@ -2,11 +2,24 @@ import os
 import json
 import hashlib
 import secrets
+import heapq
+import itertools
+import time
+import redis
+import orjson
 import firebase_admin
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
 from firebase_admin import credentials, firestore
-from flask import Flask, render_template, request, jsonify, redirect, url_for, session
+from flask import Flask, render_template, request, jsonify, redirect, url_for, session, g, has_request_context
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.local import LocalProxy
 from datetime import datetime, timezone, timedelta
-from functools import wraps
+from functools import wraps, lru_cache
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from flask_caching import Cache
+from flask_session import Session
 
 # Initialize Firebase
 if os.path.exists("serviceAccountKey.json"):
@@ -16,46 +29,473 @@ elif os.environ.get("FIREBASE_CRED"):
 else:
     cred = credentials.Default()
 
-firebase_admin.initialize_app(cred)
-db = firestore.client()
+firebase_app = firebase_admin.initialize_app(cred)
+
+# Each client owns its own gRPC channel; spreading requests over a few of
+# them stops concurrent requests queueing on a single channel. The library
+# already sets a 30s keepalive on each one
+FIRESTORE_POOL_SIZE = int(os.environ.get("FIRESTORE_POOL_SIZE", 4))
+CLIENTS = [firestore.Client(credentials=firebase_app.credential.get_credential(), project=firebase_app.project_id)
+           for _ in range(FIRESTORE_POOL_SIZE)]
+_client_counter = itertools.count()
+
+def get_db():
+    """Firestore client for the current request (round-robin across CLIENTS)"""
+    if has_request_context():
+        if 'db' not in g:
+            g.db = CLIENTS[next(_client_counter) % len(CLIENTS)]
+        return g.db
+    return CLIENTS[next(_client_counter) % len(CLIENTS)]
+
+db = LocalProxy(get_db)
+
+# Shared pool for fanning out independent Firestore reads within a request;
+# sized so one reports render (16 queries) can have them all in flight
+EXECUTOR = ThreadPoolExecutor(max_workers=int(os.environ.get("EXECUTOR_WORKERS", 16)))
+
+class OrjsonProvider(DefaultJSONProvider):
+    """jsonify/tojson through orjson. Datetimes are passed through to Flask's
+    default() so they keep the same HTTP-date format as before."""
+    
+    def _options(self):
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return option
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=self._options()).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        # The body goes out as orjson's bytes, skipping a decode/encode round trip
+        obj = self._prepare_response_obj(args, kwargs)
+        option = self._options() | orjson.OPT_APPEND_NEWLINE
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            option |= orjson.OPT_INDENT_2
+        body = orjson.dumps(obj, default=self.default, option=option)
+        return self._app.response_class(body, mimetype=self.mimetype)
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.secret_key = os.environ.get("SECRET_KEY", "smoketrack-secret-key-change-in-prod")
+SESSION_TIMEOUT = timedelta(minutes=30)
+SESSION_REFRESH_SECONDS = 60
+
+# Sessions expire after SESSION_TIMEOUT of inactivity: with Redis the key TTL
+# enforces it and the cookie only carries a session id; without Redis the
+# signed cookie's max-age does. The session is only re-saved when
+# touch_session() bumps last_active, not on every request
+app.config['PERMANENT_SESSION_LIFETIME'] = SESSION_TIMEOUT
+app.config['SESSION_REFRESH_EACH_REQUEST'] = False
+if os.environ.get("REDIS_URL"):
+    app.config.update(SESSION_TYPE='redis', SESSION_REDIS=redis.from_url(os.environ["REDIS_URL"]))
+    Session(app)
+
+# Shared cache: Redis when configured, otherwise disabled. A per-process
+# cache would only be invalidated in the worker that handled the write, so
+# the other gunicorn workers would keep serving stale totals
+if os.environ.get("REDIS_URL"):
+    cache = Cache(app, config={'CACHE_TYPE': 'RedisCache', 'CACHE_REDIS_URL': os.environ["REDIS_URL"]})
+else:
+    cache = Cache(app, config={'CACHE_TYPE': 'NullCache'})
+    print("WARNING: REDIS_URL is not set; caching is disabled and every page reads Firestore")
 
 # Business Constants
 BUNDLE_COST = 145.00
 STICKS_PER_BUNDLE = 200
+DEFAULT_TRUST_SCORE = 50
 COST_PER_STICK = BUNDLE_COST / STICKS_PER_BUNDLE
 
+# Selling price per unit and sticks per unit, by (item, payment method)
+PRICE_TABLE = {
+    ('loose', 'cash'): (1.50, 1),
+    ('loose', 'credit'): (1.50, 1),
+    ('pack', 'cash'): (30.00, 20),
+    ('pack', 'credit'): (40.00, 20)
+}
+
 # Credit Tiers
 TIER_NEW = {'name': 'new', 'limit': 80, 'min_points': 0}
 TIER_REGULAR = {'name': 'regular', 'limit': 100, 'min_points': 50}
 TIER_TRUSTED = {'name': 'trusted', 'limit': 120, 'min_points': 100}
 
-SESSION_TIMEOUT = timedelta(minutes=30)
+HISTORY_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 100
+# Reports table shows the newest bundles; the chart the newest of those
+REPORT_BUNDLE_LIMIT = 100
+BUNDLE_CHART_SIZE = 20
+
+# Argon2id password hashing for admins and customers (46 MiB, t=2)
+ph = PasswordHasher(time_cost=2, memory_cost=46 * 1024, parallelism=1)
+# Hashes run off the request threads on a small pool: argon2 releases the GIL
+# so other requests keep moving, and at most HASH_WORKERS x 46 MiB is in use
+# at once however many logins arrive together
+HASH_POOL = ThreadPoolExecutor(max_workers=int(os.environ.get("HASH_WORKERS", 2)))
+
+# Daily rollups cover the 30-day chart plus the rest of the current month
+STATS_BACKFILL_DAYS = 31
+# Bump when stats/global gains fields so existing documents get rebuilt once
+STATS_VERSION = 2
+# The daily overdue-penalty run is reported missing once its last run is this old
+PENALTY_RUN_MAX_AGE = timedelta(hours=36)
+
+# Cache keys
+DASHBOARD_CACHE_KEY = 'dashboard:aggregates'
+DASHBOARD_CACHE_TTL = 60
+DEBTORS_CACHE_KEY = 'debtors:sorted'
+DEBTORS_CACHE_TTL = 30
+BATCH_LIMIT = 500  # Firestore's cap on writes per batch
+CUSTOMER_CACHE_TTL = 30
+GOALS_CACHE_KEY = 'settings:goals'
+GOALS_CACHE_TTL = 300
+REPORTS_CACHE_KEY = 'reports:data'
+STOCK_CACHE_KEY = 'stock:data'
+HISTORY_CACHE_KEY = 'history:first-page'
+RECENT_SALES_CACHE_KEY = 'sales:recent'
+PAGE_CACHE_TTL = 30
+SALE_LIST_FIELDS = ['price', 'qty', 'customer', 'method', 'item_type', 'timestamp']
+# Everything derived from the sales collection, cleared together on sale writes
+# (the stock page shows sticks sold and remaining from the sales totals)
+SALES_CACHE_KEYS = (DASHBOARD_CACHE_KEY, REPORTS_CACHE_KEY, STOCK_CACHE_KEY, HISTORY_CACHE_KEY, RECENT_SALES_CACHE_KEY)
 
 # ---------- HELPERS ----------
 
 def hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
 
+def is_legacy_hash(stored):
+    return not stored.startswith('$argon2')
+
+def needs_rehash(stored):
+    """Legacy SHA-256 digests and Argon2 hashes made with older parameters"""
+    return is_legacy_hash(stored) or ph.check_needs_rehash(stored)
+
+def new_password_hash(password):
+    return HASH_POOL.submit(ph.hash, password).result()
+
+def verify_password(stored, password):
+    """Check a password against an Argon2 hash or a legacy unsalted SHA-256 digest"""
+    if is_legacy_hash(stored):
+        return secrets.compare_digest(stored, hash_password(password))
+    try:
+        return HASH_POOL.submit(ph.verify, stored, password).result()
+    except (VerificationError, InvalidHashError):
+        return False
+
+def check_login_password(stored, password):
+    """Verify once and return (valid, replacement hash or None). The
+    replacement is set when a legacy or outdated hash should be upgraded
+    now that the plaintext is known."""
+    if not verify_password(stored, password):
+        return False, None
+    return True, new_password_hash(password) if needs_rehash(stored) else None
+
+def request_now():
+    """Current UTC time, fixed for the rest of the request so every date
+    computed while handling it agrees"""
+    if not has_request_context():
+        return datetime.now(timezone.utc)
+    if 'now' not in g:
+        g.now = datetime.now(timezone.utc)
+    return g.now
+
+def humanize_age(seconds):
+    """'Just now', '5 min ago', '2 hours ago', '3 days ago'"""
+    if seconds < 60:
+        return "Just now"
+    if seconds < 3600:
+        return f"{seconds // 60} min ago"
+    if seconds < 86400:
+        h = seconds // 3600
+        return f"{h} hour{'s' if h > 1 else ''} ago"
+    d = seconds // 86400
+    return f"{d} day{'s' if d > 1 else ''} ago"
+
+def cache_get(key):
+    # A cache outage must never take the app down; fall back to Firestore
+    try:
+        return cache.get(key)
+    except Exception as e:
+        print(f"Cache get failed for {key}: {e}")
+        return None
+
+def cache_set(key, value, timeout):
+    try:
+        cache.set(key, value, timeout=timeout)
+    except Exception as e:
+        print(f"Cache set failed for {key}: {e}")
+
+def invalidate_cache(*keys):
+    try:
+        cache.delete_many(*keys)
+    except Exception as e:
+        print(f"Cache invalidation failed for {keys}: {e}")
+
+def aggregate_sums(query, *fields, read_time=None):
+    """Run a server-side count/sum aggregation and return {alias: value}"""
+    agg = query.count(alias='count')
+    for field in fields:
+        agg = agg.sum(field, alias=field)
+    return {r.alias: r.value for r in agg.get(read_time=read_time)[0]}
+
+def stream_pages(query, page_size=BATCH_LIMIT):
+    """Stream a query page by page so no single RPC returns an unbounded result"""
+    last = None
+    while True:
+        page = query.limit(page_size)
+        if last is not None:
+            page = page.start_after(last)
+        docs = list(page.stream())
+        yield from docs
+        if len(docs) < page_size:
+            return
+        last = docs[-1]
+
+def page_size_arg(default=HISTORY_PAGE_SIZE):
+    return min(max(request.args.get('page_size', default, type=int), 1), MAX_PAGE_SIZE)
+
+def sale_stats_update(price, sticks, method, item_type, sign=1):
+    """Increment payload for the sales rollups (sign=-1 reverses a sale)"""
+    return {
+        'cash' if method == 'cash' else 'credit': firestore.Increment(sign * price),
+        'loose' if item_type == 'loose' else 'pack': firestore.Increment(sign * price),
+        'sticks': firestore.Increment(sign * sticks)
+    }
+
+def add_sale_stats(batch, sale_date, price, sticks, method, item_type, sign=1, customer=None):
+    """Stage stats/global, daily_stats/<date> and the customer's spending
+    rollup updates for one sale on a batch"""
+    update = sale_stats_update(price, sticks, method, item_type, sign)
+    batch.set(db.collection('stats').document('global'), update, merge=True)
+    if sale_date:
+        batch.set(db.collection('daily_stats').document(sale_date.isoformat()), update, merge=True)
+    if customer is not None:
+        batch.set(spending_ref(customer),
+                  {'customer': customer, 'total_spent': firestore.Increment(sign * price)}, merge=True)
+
+def rebuild_global_stats():
+    """Backfill stats/global and the daily sales rollups from existing data.
+    
+    Lifetime totals come from aggregation queries; daily buckets are only
+    rebuilt for the last STATS_BACKFILL_DAYS since nothing reads further back.
+    
+    Every aggregation reads the data as of one read_time, outside any
+    transaction. Sales keep incrementing the rollups meanwhile, so each
+    field is written as its value at read_time plus whatever was added to
+    the rollup document since then, in a short transaction over just the
+    rollup documents. Pages racing to rebuild after a deploy serialise on
+    stats/global; the later ones find it at STATS_VERSION and keep it.
+    """
+    # One client throughout; outside a request db would round-robin the pool
+    client = get_db()
+    read_time = datetime.now(timezone.utc) - timedelta(seconds=1)
+    today = read_time.date()
+    since = today - timedelta(days=STATS_BACKFILL_DAYS)
+    
+    sales_col = client.collection('sales')
+    all_totals = aggregate_sums(sales_col, 'price', 'qty', read_time=read_time)
+    cash = aggregate_sums(sales_col.where('method', '==', 'cash'), 'price', read_time=read_time)['price']
+    loose = aggregate_sums(sales_col.where('item_type', '==', 'loose'), 'price', read_time=read_time)['price']
+    stock = aggregate_sums(client.collection('stock'), 'bundles', 'sticks', 'cost', read_time=read_time)
+    totals = {
+        'cash': cash,
+        'credit': all_totals['price'] - cash,
+        'loose': loose,
+        'pack': all_totals['price'] - loose,
+        'sticks': all_totals['qty'],
+        'stock_bundles': stock['bundles'],
+        'stock_sticks': stock['sticks'],
+        'stock_cost': stock['cost'],
+        'expenses_total': aggregate_sums(client.collection('expenses'), 'amount', read_time=read_time)['amount'],
+        'injections_total': aggregate_sums(client.collection('personal_injections'), 'amount', read_time=read_time)['amount'],
+    }
+    
+    stats_ref = client.collection('stats').document('global')
+    day_refs = {day_iso: client.collection('daily_stats').document(day_iso)
+                for day_iso in ((since + timedelta(days=i)).isoformat() for i in range((today - since).days + 1))}
+    daily = {day_iso: {'cash': 0, 'credit': 0, 'loose': 0, 'pack': 0, 'sticks': 0} for day_iso in day_refs}
+    since_dt = datetime.combine(since, datetime.min.time(), tzinfo=timezone.utc)
+    recent = sales_col.where('timestamp', '>=', since_dt).select(['price', 'qty', 'method', 'item_type', 'timestamp'])
+    for s in recent.stream(read_time=read_time):
+        data = s.to_dict()
+        ts = data.get('timestamp')
+        if not ts:
+            continue
+        if ts.tzinfo is None:
+            ts = ts.replace(tzinfo=timezone.utc)
+        day = daily.get(ts.date().isoformat())
+        if day is None:
+            continue
+        price = data.get('price', 0)
+        day['cash' if data.get('method', 'cash') == 'cash' else 'credit'] += price
+        day['loose' if data.get('item_type', 'pack') == 'loose' else 'pack'] += price
+        day['sticks'] += data.get('qty', 0)
+    
+    rebuilt = {stats_ref.path: totals, **{ref.path: daily[day_iso] for day_iso, ref in day_refs.items()}}
+    refs = [stats_ref, *day_refs.values()]
+    at_read_time = {d.reference.path: d.to_dict() or {} for d in client.get_all(refs, read_time=read_time)}
+    
+    @firestore.transactional
+    def apply(transaction):
+        current = {d.reference.path: d.to_dict() or {} for d in transaction.get_all(refs)}
+        stats = current[stats_ref.path]
+        if stats.get('version', 0) >= STATS_VERSION:
+            return stats
+        for ref in refs:
+            before, after = at_read_time[ref.path], current[ref.path]
+            fields = {field: value + after.get(field, 0) - before.get(field, 0)
+                      for field, value in rebuilt[ref.path].items()}
+            if ref is stats_ref:
+                fields['version'] = STATS_VERSION
+                stats = {**stats, **fields}
+            transaction.set(ref, fields, merge=True)
+        return stats
+    
+    return apply(client.transaction())
+
+def spending_ref(customer):
+    """customer_spending document for a sale's customer name. Names are hashed
+    into the ID since they can be empty or contain '/'"""
+    return db.collection('customer_spending').document(hashlib.sha256(customer.encode()).hexdigest())
+
+def rebuild_customer_spending():
+    """Backfill customer_spending from sales recorded before live counting.
+    
+    Live sales carry spending_counted and are added by add_sale_stats, so
+    only unmarked sales are summed here. Their totals are added with
+    Increments, and each sale is marked in the same batch on condition that
+    it is unchanged since it was read: live increments are never overwritten,
+    and a concurrent delete or second backfill fails the batch instead of
+    double counting. Whatever a failed batch left unmarked is picked up by
+    the next run, since the flag is only set once every sale is marked.
+    """
+    query = db.collection('sales').select(['customer', 'price', 'spending_counted'])
+    batch = db.batch()
+    spending = defaultdict(float)
+    
+    def commit_pending():
+        for customer, total_spent in spending.items():
+            batch.set(spending_ref(customer),
+                      {'customer': customer, 'total_spent': firestore.Increment(total_spent)}, merge=True)
+        batch.commit()
+        spending.clear()
+    
+    for s in stream_pages(query):
+        data = s.to_dict()
+        if data.get('spending_counted'):
+            continue
+        spending[data.get('customer', 'Cash Customer')] += data.get('price', 0)
+        batch.update(s.reference, {'spending_counted': True}, option=db.write_option(last_update_time=s.update_time))
+        if len(batch) + len(spending) >= BATCH_LIMIT - 1:
+            commit_pending()
+            batch = db.batch()
+    batch.set(db.collection('stats').document('global'), {'customer_spending_backfilled': True}, merge=True)
+    commit_pending()
+
+def get_top_spenders(limit=5):
+    """[(customer, total_spent)] for the biggest spenders, highest first"""
+    if not get_global_stats().get('customer_spending_backfilled'):
+        rebuild_customer_spending()
+    top = db.collection('customer_spending').order_by('total_spent', direction=firestore.Query.DESCENDING).limit(limit)
+    return [(data['customer'], data['total_spent']) for data in (r.to_dict() for r in top.stream())]
+
+def debtor_to_dict(doc):
+    """Debtor snapshot as a template dict, filling fields a merge-created debtor lacks"""
+    data = doc.to_dict()
+    data['name'] = doc.id
+    data.setdefault('trust_score', DEFAULT_TRUST_SCORE)
+    data.setdefault('created', doc.create_time)
+    return data
+
+def get_global_stats():
+    """Lifetime totals from stats/global, backfilling it on first use"""
+    doc = db.collection('stats').document('global').get()
+    totals = doc.to_dict() if doc.exists else {}
+    if totals.get('version', 0) < STATS_VERSION:
+        totals = rebuild_global_stats()
+    return totals
+
+def get_debtors():
+    """All debtors as dicts, highest balance first (cached; cleared on debtor writes)"""
+    debtor_list = cache_get(DEBTORS_CACHE_KEY)
+    if debtor_list is None:
+        debtors = db.collection('debtors').order_by('balance', direction=firestore.Query.DESCENDING).stream()
+        debtor_list = [debtor_to_dict(d) for d in debtors]
+        cache_set(DEBTORS_CACHE_KEY, debtor_list, DEBTORS_CACHE_TTL)
+    return debtor_list
+
+def get_customer(phone):
+    """Customer dict, looked up in the request, then the shared cache, then Firestore"""
+    customers = g.setdefault('customers', {})
+    if phone not in customers:
+        cust = cache_get(f'customer:{phone}')
+        if cust is None:
+            doc = db.collection('customers').document(phone).get()
+            cust = doc.to_dict() if doc.exists else None
+            if cust is not None:
+                cache_set(f'customer:{phone}', cust, CUSTOMER_CACHE_TTL)
+        customers[phone] = cust
+    return customers[phone]
+
+def invalidate_customer(phone):
+    """Call after every write to customers/<phone>"""
+    if has_request_context():
+        g.get('customers', {}).pop(phone, None)
+    invalidate_cache(f'customer:{phone}')
+
+def customer_phone_for(name, debtor=None):
+    """Phone of the registered customer behind a debtor name, or None.
+    Debtors store the answer as customer_phone (None meaning no registered
+    customer), so the name query only runs once per debtor: when it is
+    first created, or for debtors recorded before that field existed."""
+    if debtor is not None and 'customer_phone' in debtor:
+        return debtor['customer_phone']
+    for c in db.collection('customers').where('name', '==', name).limit(1).select([]).stream():
+        return c.id
+    return None
+
+def get_goals():
+    goals = cache_get(GOALS_CACHE_KEY)
+    if goals is None:
+        goals_doc = db.collection('settings').document('goals').get()
+        goals = goals_doc.to_dict() if goals_doc.exists else {'daily': 500, 'monthly': 15000}
+        cache_set(GOALS_CACHE_KEY, goals, GOALS_CACHE_TTL)
+    return goals
+
 def calculate_tier(points):
     if points >= 100: return TIER_TRUSTED
     elif points >= 50: return TIER_REGULAR
     else: return TIER_NEW
 
-def update_customer_tier(customer_ref, points):
+def tier_fields(points):
+    """Customer fields that follow from a loyalty points total"""
     tier_info = calculate_tier(points)
-    customer_ref.update({
+    return {
         'loyalty_points': points,
         'tier': tier_info['name'],
         'credit_limit': tier_info['limit']
-    })
+    }
+
+def customer_charge(customer_ref, debt, points):
+    """Customer update adding debt and points with Increment. The tier still
+    depends on the points total, so that is read only when points change."""
+    update = {'current_debt': firestore.Increment(debt)}
+    if points:
+        current = (customer_ref.get(['loyalty_points']).to_dict() or {}).get('loyalty_points', 0)
+        update.update(tier_fields(current + points))
+        update['loyalty_points'] = firestore.Increment(points)
+    return update
 
 def check_overdue_penalties():
     """Check all customers for 4-week overdue and 10% debt increase"""
-    customers = db.collection('customers').where('approved', '==', True).stream()
-    now = datetime.now(timezone.utc)
+    # Customers without debt can't be penalised; (approved, current_debt) index
+    customers = stream_pages(db.collection('customers').where('approved', '==', True).where('current_debt', '>', 0))
+    now = request_now()
+    batch = db.batch()
+    penalised = []
     
     for c in customers:
         data = c.to_dict()
@@ -65,6 +505,9 @@ def check_overdue_penalties():
         current_debt = data.get('current_debt', 0)
         if current_debt == 0:
             continue
+        
+        reasons = []
+        update = {}
             
         # Check 4-week overdue
         last_check = data.get('last_debt_check')
@@ -73,47 +516,73 @@ def check_overdue_penalties():
                 last_check = last_check.replace(tzinfo=timezone.utc)
             weeks_overdue = (now - last_check).days / 7
             if weeks_overdue >= 4:
-                # Deduct 2 points
-                new_points = max(0, data.get('loyalty_points', 0) - 2)
-                update_customer_tier(db.collection('customers').document(phone), new_points)
-                # Log point change
-                db.collection('point_history').add({
-                    'customer_phone': phone,
-                    'change': -2,
-                    'reason': '4 weeks overdue',
-                    'timestamp': now
-                })
+                reasons.append('4 weeks overdue')
                 # Reset check date
-                db.collection('customers').document(phone).update({'last_debt_check': now})
+                update['last_debt_check'] = now
         
         # Check 10% debt increase
         debt_at_check = data.get('debt_at_last_check', 0)
         if debt_at_check > 0:
             increase_pct = ((current_debt - debt_at_check) / debt_at_check) * 100
             if increase_pct >= 10:
-                # Deduct 2 points
-                new_points = max(0, data.get('loyalty_points', 0) - 2)
-                update_customer_tier(db.collection('customers').document(phone), new_points)
-                # Log point change
-                db.collection('point_history').add({
-                    'customer_phone': phone,
-                    'change': -2,
-                    'reason': f'Debt increased {increase_pct:.1f}%',
-                    'timestamp': now
-                })
+                reasons.append(f'Debt increased {increase_pct:.1f}%')
                 # Update baseline
-                db.collection('customers').document(phone).update({'debt_at_last_check': current_debt})
+                update['debt_at_last_check'] = current_debt
+        
+        if not reasons:
+            continue
+        
+        # Deduct 2 points per penalty
+        new_points = max(0, data.get('loyalty_points', 0) - 2 * len(reasons))
+        batch.update(c.reference, {**update, **tier_fields(new_points)})
+        # Log point changes
+        for reason in reasons:
+            batch.set(db.collection('point_history').document(), {
+                'customer_phone': phone,
+                'change': -2,
+                'reason': reason,
+                'timestamp': now
+            })
+        penalised.append(phone)
+        
+        if len(batch) >= BATCH_LIMIT - 3:
+            batch.commit()
+            batch = db.batch()
+    
+    # Recorded so the dashboard can flag a scheduler that stopped calling in
+    batch.set(db.collection('stats').document('global'), {'penalties_last_run': now}, merge=True)
+    batch.commit()
+    for phone in penalised:
+        invalidate_customer(phone)
+    return penalised
+
+@app.before_request
+def touch_session():
+    """Slide the inactivity window for logged-in sessions, clearing expired ones.
+    last_active is only rewritten when stale, so most requests leave the
+    session unmodified and nothing is re-signed or re-saved."""
+    if 'user' not in session and 'customer_phone' not in session:
+        return
+    now = int(time.time())
+    last_active = session.get('last_active', now)
+    if isinstance(last_active, str):
+        # Sessions from before epoch stamps hold a naive local ISO timestamp
+        try:
+            last_active = int(datetime.fromisoformat(last_active).timestamp())
+        except ValueError:
+            last_active = 0
+    elif not isinstance(last_active, (int, float)):
+        last_active = 0
+    if now - last_active > SESSION_TIMEOUT.total_seconds():
+        session.clear()
+    elif now - last_active >= SESSION_REFRESH_SECONDS or 'last_active' not in session:
+        session['last_active'] = now
 
 def login_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
         if 'user' not in session:
             return redirect(url_for('login'))
-        last_active = session.get('last_active')
-        if last_active and datetime.now() > datetime.fromisoformat(last_active) + SESSION_TIMEOUT:
-            session.clear()
-            return redirect(url_for('login'))
-        session['last_active'] = datetime.now().isoformat()
         return f(*args, **kwargs)
     return decorated
 
@@ -138,13 +607,20 @@ def login():
     username = data.get('username', '').strip()
     password = data.get('password', '')
     doc = db.collection('users').document(username).get()
+    user = doc.to_dict() if doc.exists else None
     
-    if not doc.exists or doc.to_dict()['password'] != hash_password(password):
+    valid, new_hash = check_login_password(user['password'], password) if user else (False, None)
+    if not valid:
         return jsonify({"status": "error", "message": "Invalid credentials"})
     
+    # Lazily migrate legacy/outdated hashes now that we know the password
+    if new_hash:
+        doc.reference.update({'password': new_hash})
+    
     session['user'] = username
-    session['role'] = doc.to_dict().get('role', 'seller')
-    session['last_active'] = datetime.now().isoformat()
+    session['role'] = user.get('role', 'seller')
+    session['last_active'] = int(time.time())
+    session.permanent = True
     return jsonify({"status": "success"})
 
 @app.route('/logout')
@@ -166,9 +642,9 @@ def setup_admin():
         return jsonify({"status": "error", "message": "Password must be 4+ characters"})
     
     db.collection('users').document(username).set({
-        'password': hash_password(password),
+        'password': new_password_hash(password),
         'role': 'admin',
-        'created': datetime.now(timezone.utc)
+        'created': firestore.SERVER_TIMESTAMP
     })
     return jsonify({"status": "success"})
 
@@ -196,7 +672,7 @@ def customer_register():
         'name': name,
         'phone': phone,
         'house_number': house,
-        'password_hash': hash_password(password),
+        'password_hash': new_password_hash(password),
         'approved': False,
         'credit_enabled': False,
         'credit_limit': 80,
@@ -205,10 +681,18 @@ def customer_register():
         'tier_override': False,
         'cash_on_hand': 0,
         'current_debt': 0,
-        'last_debt_check': datetime.now(timezone.utc),
+        'last_debt_check': firestore.SERVER_TIMESTAMP,
         'debt_at_last_check': 0,
-        'created': datetime.now(timezone.utc)
+        'created': firestore.SERVER_TIMESTAMP
     })
+    # A walk-in debtor of the same name was stored as having no customer;
+    # link it now so their credit sales and payments reach this account
+    debtor_ref = db.collection('debtors').document(name)
+    debtor = debtor_ref.get(['customer_phone'])
+    if debtor.exists and not debtor.to_dict().get('customer_phone'):
+        debtor_ref.update({'customer_phone': phone})
+        invalidate_cache(DEBTORS_CACHE_KEY)
+    invalidate_cache(DASHBOARD_CACHE_KEY)  # pending customer count
     return jsonify({"status": "success", "message": "Registration submitted. Wait for approval."})
 
 @app.route('/customer/login', methods=['GET', 'POST'])
@@ -227,14 +711,21 @@ def customer_login():
         return jsonify({"status": "error", "message": "Invalid phone or password"})
     
     cust = doc.to_dict()
-    if cust['password_hash'] != hash_password(password):
+    valid, new_hash = check_login_password(cust['password_hash'], password)
+    if not valid:
         return jsonify({"status": "error", "message": "Invalid phone or password"})
     
+    if new_hash:
+        doc.reference.update({'password_hash': new_hash})
+        invalidate_customer(phone)
+    
     if not cust.get('approved', False):
         return jsonify({"status": "error", "message": "Account pending approval"})
     
     session['customer_phone'] = phone
     session['customer_name'] = cust['name']
+    session['last_active'] = int(time.time())
+    session.permanent = True
     return jsonify({"status": "success"})
 
 @app.route('/customer/logout')
@@ -249,27 +740,31 @@ def customer_logout():
 @customer_login_required
 def customer_dashboard():
     phone = session['customer_phone']
-    cust = db.collection('customers').document(phone).get().to_dict()
+    cust = get_customer(phone)
+    
+    newest_first = firestore.Query.DESCENDING
+    
+    # The four history queries are independent, so run them concurrently
+    f_sales = EXECUTOR.submit(lambda: list(db.collection('sales').where('customer', '==', cust['name']).order_by('timestamp', direction=newest_first).limit(20).stream()))
+    f_payments = EXECUTOR.submit(lambda: list(db.collection('payments').where('customer', '==', cust['name']).order_by('timestamp', direction=newest_first).limit(20).stream()))
+    f_orders = EXECUTOR.submit(lambda: list(db.collection('orders').where('customer_phone', '==', phone).order_by('timestamp', direction=newest_first).limit(10).stream()))
+    f_points = EXECUTOR.submit(lambda: list(db.collection('point_history').where('customer_phone', '==', phone).order_by('timestamp', direction=newest_first).limit(10).stream()))
     
     # Get purchase history
-    sales = db.collection('sales').where('customer', '==', cust['name']).order_by('timestamp', direction=firestore.Query.DESCENDING).limit(20).stream()
-    purchases = [s.to_dict() for s in sales]
+    purchases = [s.to_dict() for s in f_sales.result()]
     
     # Get payment history
-    payments = db.collection('payments').where('customer', '==', cust['name']).order_by('timestamp', direction=firestore.Query.DESCENDING).limit(20).stream()
-    payment_list = [p.to_dict() for p in payments]
+    payment_list = [p.to_dict() for p in f_payments.result()]
     
     # Get orders
-    orders = db.collection('orders').where('customer_phone', '==', phone).order_by('timestamp', direction=firestore.Query.DESCENDING).limit(10).stream()
     order_list = []
-    for o in orders:
+    for o in f_orders.result():
         od = o.to_dict()
         od['id'] = o.id
         order_list.append(od)
     
     # Point history
-    points_hist = db.collection('point_history').where('customer_phone', '==', phone).order_by('timestamp', direction=firestore.Query.DESCENDING).limit(10).stream()
-    point_list = [p.to_dict() for p in points_hist]
+    point_list = [p.to_dict() for p in f_points.result()]
     
     # Tier progress
     tier_info = calculate_tier(cust['loyalty_points'])
@@ -295,7 +790,7 @@ def customer_dashboard():
 @customer_login_required
 def customer_create_order():
     phone = session['customer_phone']
-    cust = db.collection('customers').document(phone).get().to_dict()
+    cust = get_customer(phone)
     
     data = request.json
     items = data.get('items', [])  # [{'type': 'loose', 'qty': 5}, {'type': 'pack', 'qty': 2}]
@@ -308,13 +803,11 @@ def customer_create_order():
     total = 0
     total_sticks = 0
     for item in items:
-        if item['type'] == 'loose':
-            total += 1.50 * item['qty']
-            total_sticks += item['qty']
-        else:  # pack
-            price_per = 40 if payment_method == 'credit' else 30
-            total += price_per * item['qty']
-            total_sticks += item['qty'] * 20
+        if (item['type'], payment_method) not in PRICE_TABLE:
+            return jsonify({"status": "error", "message": "Unknown item or payment method"})
+        unit_price, sticks_per_unit = PRICE_TABLE[(item['type'], payment_method)]
+        total += unit_price * item['qty']
+        total_sticks += sticks_per_unit * item['qty']
     
     # Check credit limit if credit
     if payment_method == 'credit':
@@ -334,8 +827,9 @@ def customer_create_order():
         'total_sticks': total_sticks,
         'payment_method': payment_method,
         'status': 'pending',
-        'timestamp': datetime.now(timezone.utc)
+        'timestamp': firestore.SERVER_TIMESTAMP
     })
+    invalidate_cache(DASHBOARD_CACHE_KEY)  # pending order count
     
     return jsonify({"status": "success", "message": "Order submitted!"})
 
@@ -347,80 +841,79 @@ def customer_update_cash():
     amount = float(data.get('amount', 0))
     
     db.collection('customers').document(phone).update({'cash_on_hand': amount})
+    invalidate_customer(phone)
     return jsonify({"status": "success"})
 
 # ---------- ADMIN DASHBOARD ----------
 
-@app.route('/')
-@login_required
-def dashboard():
-    # Run penalty checks
-    check_overdue_penalties()
-    
-    sales = list(db.collection('sales').stream())
-    debtors = list(db.collection('debtors').stream())
+def compute_dashboard_stats():
+    """Build the dashboard template values (everything except the user badge)"""
+    now = request_now()
+    today = now.date()
+    month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    first_day = min(today - timedelta(days=29), month_start.date())
+    day_refs = [db.collection('daily_stats').document((today - timedelta(days=i)).isoformat())
+                for i in range((today - first_day).days + 1)]
+    
+    # All reads are independent, so fire them concurrently
+    f_totals = EXECUTOR.submit(get_global_stats)
+    f_daily = EXECUTOR.submit(lambda: [d for d in db.get_all(day_refs) if d.exists])
+    f_debtors = EXECUTOR.submit(get_debtors)
+    f_goals = EXECUTOR.submit(get_goals)
+    f_orders = EXECUTOR.submit(aggregate_sums, db.collection('orders').where('status', '==', 'pending'))
+    f_customers = EXECUTOR.submit(aggregate_sums, db.collection('customers').where('approved', '==', False))
+    
+    # Lifetime totals from the rollup document
+    totals = f_totals.result()
+    cash_total = totals.get('cash', 0)
+    credit_total = totals.get('credit', 0)
+    loose_total = totals.get('loose', 0)
+    pack_total = totals.get('pack', 0)
+    total_sticks_sold = totals.get('sticks', 0)
+    
+    last_penalty_run = totals.get('penalties_last_run')
+    if last_penalty_run is None or now - last_penalty_run > PENALTY_RUN_MAX_AGE:
+        print(f"WARNING: overdue penalties last ran {last_penalty_run or 'never'}; "
+              f"check the cron.yaml / Cloud Scheduler job for /tasks/overdue-penalties")
+    
+    # Daily rollups for the chart window and the current month, keyed by day offset
+    day_offsets = {ref.id: i for i, ref in enumerate(day_refs)}
+    daily_stats = [(day_offsets[d.id], d.to_dict()) for d in f_daily.result()]
     
-    cash_total = 0
-    credit_total = 0
-    total_sticks_sold = 0
-    today = datetime.now(timezone.utc).date()
-    yesterday = today - timedelta(days=1)
     daily_sales = 0
     yesterday_sales = 0
-    yesterday_profit = 0
-    
-    # Line chart last 30 days
-    last_30 = {}
-    for i in range(30):
-        d = (datetime.now(timezone.utc) - timedelta(days=i)).date()
-        last_30[d.isoformat()] = {'cash': 0, 'credit': 0, 'sticks': 0}
-    
-    # Pie counters
-    loose_total = 0
-    pack_total = 0
-    cash_pie = 0
-    credit_pie = 0
-    
-    for s in sales:
-        data = s.to_dict()
-        price = data.get('price', 0)
-        qty = data.get('qty', 0)
-        method = data.get('method', 'cash')
-        item_type = data.get('item_type', 'pack')
+    yesterday_sticks = 0
+    monthly_sales = 0
+    monthly_sticks = 0
+    month_offset = (today - month_start.date()).days
+    
+    # Line chart last 30 days, indexed by day offset (today first)
+    line_cash = [0.0] * 30
+    line_credit = [0.0] * 30
+    line_sticks = [0] * 30
+    
+    for offset, day in daily_stats:
+        cash = day.get('cash', 0)
+        credit = day.get('credit', 0)
+        qty = day.get('sticks', 0)
+        price = cash + credit
         
-        if method == 'cash':
-            cash_total += price
-        else:
-            credit_total += price
-        total_sticks_sold += qty
-        
-        ts = data.get('timestamp')
-        if ts:
-            if ts.tzinfo is None:
-                ts = ts.replace(tzinfo=timezone.utc)
-            sale_date = ts.date()
-            
-            if sale_date == today:
-                daily_sales += price
-            elif sale_date == yesterday:
-                yesterday_sales += price
-                yesterday_profit += price - (qty * COST_PER_STICK)
-            
-            sale_date_iso = sale_date.isoformat()
-            if sale_date_iso in last_30:
-                last_30[sale_date_iso]['cash' if method == 'cash' else 'credit'] += price
-                last_30[sale_date_iso]['sticks'] += qty
+        if offset <= month_offset:
+            monthly_sales += price
+            monthly_sticks += qty
         
-        if item_type == 'loose':
-            loose_total += price
-        else:
-            pack_total += price
+        if offset == 0:
+            daily_sales += price
+        elif offset == 1:
+            yesterday_sales += price
+            yesterday_sticks += qty
         
-        if method == 'cash':
-            cash_pie += price
-        else:
-            credit_pie += price
+        if offset < 30:
+            line_cash[offset] = cash
+            line_credit[offset] = credit
+            line_sticks[offset] = qty
     
+    yesterday_profit = yesterday_sales - (yesterday_sticks * COST_PER_STICK)
     total_cost = total_sticks_sold * COST_PER_STICK
     net_profit = (cash_total + credit_total) - total_cost
     
@@ -430,35 +923,21 @@ def dashboard():
     else:
         risk_level = "HIGH" if credit_total > 0 else "SAFE"
     
-    debtor_list = []
-    for d in debtors:
-        dd = d.to_dict()
-        dd['name'] = d.id
-        debtor_list.append(dd)
-    debtor_list.sort(key=lambda x: x['balance'], reverse=True)
+    debtor_list = f_debtors.result()
     
     # Stock calculations
-    stock_docs = list(db.collection('stock').stream())
-    total_sticks_from_stock = sum(s.to_dict()['sticks'] for s in stock_docs)
+    total_sticks_from_stock = totals.get('stock_sticks', 0)
     sticks_remaining = total_sticks_from_stock - total_sticks_sold
     
     # Stock alert level
     stock_alert = "out" if sticks_remaining <= 0 else "low" if sticks_remaining < 200 else "safe"
     
     # Goals
-    goals_doc = db.collection('settings').document('goals').get()
-    if goals_doc.exists:
-        goals = goals_doc.to_dict()
-    else:
-        goals = {'daily': 500, 'monthly': 15000}
-    
-    # Calculate monthly sales
-    month_start = datetime.now(timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    monthly_sales = sum(s.to_dict()['price'] for s in sales if s.to_dict().get('timestamp', datetime.now(timezone.utc)) >= month_start)
+    goals = f_goals.result()
     
     # Cash flow forecast
     if daily_sales > 0 and sticks_remaining > 0:
-        avg_sticks_per_day = total_sticks_sold / max(1, (datetime.now(timezone.utc) - month_start).days)
+        avg_sticks_per_day = monthly_sticks / (month_offset + 1)
         days_until_out = int(sticks_remaining / max(1, avg_sticks_per_day))
         bundles_needed = max(1, int((avg_sticks_per_day * 7) / STICKS_PER_BUNDLE))
     else:
@@ -466,53 +945,80 @@ def dashboard():
         bundles_needed = 1
     
     # Pending orders & customers
-    pending_orders = db.collection('orders').where('status', '==', 'pending').stream()
-    pending_order_count = len(list(pending_orders))
-    
-    pending_customers = db.collection('customers').where('approved', '==', False).stream()
-    pending_customer_count = len(list(pending_customers))
-    
-    # Chart data
-    line_labels = sorted(last_30.keys())
-    line_cash = [last_30[d]['cash'] for d in line_labels]
-    line_credit = [last_30[d]['credit'] for d in line_labels]
-    line_sticks = [last_30[d]['sticks'] for d in line_labels]
-    line_labels_display = [datetime.fromisoformat(d).strftime('%d %b') for d in line_labels]
+    pending_order_count = f_orders.result()['count']
+    pending_customer_count = f_customers.result()['count']
+    
+    # Chart data, oldest first
+    line_labels_display = [(today - timedelta(days=offset)).strftime('%d %b') for offset in range(29, -1, -1)]
+    line_cash.reverse()
+    line_credit.reverse()
+    line_sticks.reverse()
+    # Serialised once here (and cached with the rest) instead of per render
+    chart_payload = orjson.dumps({
+        'labels': line_labels_display,
+        'cash': line_cash,
+        'credit': line_credit,
+        'sticks': line_sticks
+    }).decode()
     
     profit_pie = max(0, (cash_total + credit_total) - total_cost)
     cost_pie = total_cost
     
-    return render_template('dashboard.html',
-                           cash=round(cash_total, 2),
-                           credit=round(credit_total, 2),
-                           profit=round(net_profit, 2),
-                           daily=round(daily_sales, 2),
-                           risk=risk_level,
-                           debtors=debtor_list,
-                           sticks_sold=total_sticks_sold,
-                           sticks_remaining=sticks_remaining,
-                           stock_alert=stock_alert,
-                           yesterday_sales=round(yesterday_sales, 2),
-                           yesterday_profit=round(yesterday_profit, 2),
-                           daily_goal=goals['daily'],
-                           monthly_goal=goals['monthly'],
-                           monthly_sales=round(monthly_sales, 2),
-                           days_until_out=days_until_out,
-                           bundles_needed=bundles_needed,
-                           pending_orders=pending_order_count,
-                           pending_customers=pending_customer_count,
-                           line_labels=line_labels_display,
-                           line_cash=line_cash,
-                           line_credit=line_credit,
-                           line_sticks=line_sticks,
-                           loose_total=round(loose_total, 2),
-                           pack_total=round(pack_total, 2),
-                           cash_pie=round(cash_pie, 2),
-                           credit_pie=round(credit_pie, 2),
-                           profit_pie=round(profit_pie, 2),
-                           cost_pie=round(cost_pie, 2),
-                           user=session.get('user'),
-                           role=session.get('role'))
+    return dict(cash=round(cash_total, 2),
+                credit=round(credit_total, 2),
+                profit=round(net_profit, 2),
+                daily=round(daily_sales, 2),
+                risk=risk_level,
+                debtors=debtor_list,
+                sticks_sold=total_sticks_sold,
+                sticks_remaining=sticks_remaining,
+                stock_alert=stock_alert,
+                yesterday_sales=round(yesterday_sales, 2),
+                yesterday_profit=round(yesterday_profit, 2),
+                daily_goal=goals['daily'],
+                monthly_goal=goals['monthly'],
+                monthly_sales=round(monthly_sales, 2),
+                days_until_out=days_until_out,
+                bundles_needed=bundles_needed,
+                pending_orders=pending_order_count,
+                pending_customers=pending_customer_count,
+                chart_payload=chart_payload,
+                loose_total=round(loose_total, 2),
+                pack_total=round(pack_total, 2),
+                cash_pie=round(cash_total, 2),
+                credit_pie=round(credit_total, 2),
+                profit_pie=round(profit_pie, 2),
+                cost_pie=round(cost_pie, 2))
+
+@app.route('/')
+@login_required
+def dashboard():
+    stats = cache_get(DASHBOARD_CACHE_KEY)
+    if stats is None:
+        stats = compute_dashboard_stats()
+        cache_set(DASHBOARD_CACHE_KEY, stats, DASHBOARD_CACHE_TTL)
+    
+    return render_template('dashboard.html', **stats, user=session.get('user'), role=session.get('role'))
+
+@app.route('/tasks/overdue-penalties', methods=['GET', 'POST'])
+def run_overdue_penalties():
+    """Daily penalty run, triggered by cron.yaml on App Engine (which can only
+    send GET) or by a Cloud Scheduler POST carrying CRON_TOKEN in X-Cron-Token.
+    Admins can also POST it as JSON; a cross-site form or image can't"""
+    cron_token = os.environ.get('CRON_TOKEN')
+    # App Engine strips X-Appengine-Cron from outside requests; elsewhere it can be forged
+    from_app_engine = os.environ.get('GAE_ENV') and request.headers.get('X-Appengine-Cron') == 'true'
+    if request.method == 'GET':
+        allowed = from_app_engine
+    else:
+        allowed = (from_app_engine
+                   or (cron_token and secrets.compare_digest(request.headers.get('X-Cron-Token', ''), cron_token))
+                   or (request.is_json and session.get('role') == 'admin'))
+    if not allowed:
+        return jsonify({"status": "error", "message": "Forbidden"}), 403
+    
+    penalised = check_overdue_penalties()
+    return jsonify({"status": "success", "penalised": len(penalised)})
 
 @app.route('/sell', methods=['POST'])
 @login_required
@@ -522,64 +1028,64 @@ def process_sale():
     method = data['method']
     qty = int(data.get('qty', 1))
     
-    if item == 'loose':
-        price = 1.50 * qty
-        sticks = qty
-    else:
-        unit_price = 40.00 if method == 'credit' else 30.00
-        price = unit_price * qty
-        sticks = qty * 20
+    if (item, method) not in PRICE_TABLE:
+        return jsonify({"status": "error", "message": "Unknown item or payment method"}), 400
+    unit_price, sticks_per_unit = PRICE_TABLE[(item, method)]
+    price = unit_price * qty
+    sticks = sticks_per_unit * qty
     
     customer_name = data.get('name', 'Cash Customer')
+    now = request_now()  # only picks the daily rollup bucket
     
-    db.collection('sales').add({
+    # Sale, rollups, debtor and customer are committed together
+    phone = None
+    batch = db.batch()
+    batch.set(db.collection('sales').document(), {
         'qty': sticks,
         'price': price,
         'method': method,
         'customer': customer_name,
-        'timestamp': datetime.now(timezone.utc),
-        'item_type': item
+        'timestamp': firestore.SERVER_TIMESTAMP,
+        'item_type': item,
+        'spending_counted': True
     })
+    add_sale_stats(batch, now.date(), price, sticks, method, item,
+                   customer=customer_name)
     
     if method == 'credit':
         debtor_ref = db.collection('debtors').document(customer_name)
-        doc = debtor_ref.get()
-        if doc.exists:
-            debtor_ref.update({
-                'balance': firestore.Increment(price),
-                'last_purchase': datetime.now(timezone.utc)
-            })
-        else:
-            debtor_ref.set({
-                'balance': price,
-                'trust_score': 50,
-                'created': datetime.now(timezone.utc),
-                'last_purchase': datetime.now(timezone.utc)
-            })
+        # The POS sends the phone it already has for a known debtor; anyone
+        # else is resolved from the debtor doc (and at most once by name)
+        phone = data.get('customer_phone') or None
+        if phone is None:
+            debtor = debtor_ref.get(['customer_phone'])
+            phone = customer_phone_for(customer_name, debtor.to_dict() if debtor.exists else None)
         
-        # Update customer debt and points
-        cust = db.collection('customers').where('name', '==', customer_name).limit(1).stream()
-        for c in cust:
-            phone = c.id
-            cust_data = c.to_dict()
-            new_debt = cust_data.get('current_debt', 0) + price
-            new_points = cust_data.get('loyalty_points', 0) + (sticks // 20)
-            
-            db.collection('customers').document(phone).update({
-                'current_debt': new_debt,
-                'loyalty_points': new_points
-            })
+        # Merge + Increment creates or tops up the debtor
+        batch.set(debtor_ref, {
+            'balance': firestore.Increment(price),
+            'last_purchase': firestore.SERVER_TIMESTAMP,
+            'customer_phone': phone
+        }, merge=True)
+        
+        # Update customer debt, points and tier
+        if phone:
+            cust_ref = db.collection('customers').document(phone)
+            batch.update(cust_ref, customer_charge(cust_ref, price, sticks // 20))
             
             # Log points
             if sticks >= 20:
-                db.collection('point_history').add({
+                batch.set(db.collection('point_history').document(), {
                     'customer_phone': phone,
                     'change': sticks // 20,
                     'reason': f'Purchase: {sticks} sticks',
-                    'timestamp': datetime.now(timezone.utc)
+                    'timestamp': firestore.SERVER_TIMESTAMP
                 })
-            
-            update_customer_tier(db.collection('customers').document(phone), new_points)
+    batch.commit()
+    if phone:
+        invalidate_customer(phone)
+    
+    invalidate_cache(*SALES_CACHE_KEYS, DEBTORS_CACHE_KEY)
     
     profit_made = price - (sticks * COST_PER_STICK)
     return jsonify({
@@ -600,48 +1106,57 @@ def record_payment():
     if not doc.exists:
         return jsonify({"status": "error", "message": "Debtor not found"}), 404
     
-    current_balance = doc.to_dict()['balance']
+    debtor = doc.to_dict()
+    current_balance = debtor['balance']
     new_balance = max(0, current_balance - amount)
+    phone = customer_phone_for(name, debtor)
     
+    # Debtor, payment log and customer are committed together
+    batch = db.batch()
     if new_balance == 0:
-        debtor_ref.delete()
+        batch.delete(debtor_ref)
     else:
-        debtor_ref.update({
+        batch.update(debtor_ref, {
             'balance': new_balance,
-            'last_payment': datetime.now(timezone.utc)
+            'last_payment': firestore.SERVER_TIMESTAMP,
+            'customer_phone': phone
         })
     
-    db.collection('payments').add({
+    batch.set(db.collection('payments').document(), {
         'customer': name,
         'amount': amount,
-        'timestamp': datetime.now(timezone.utc),
+        'timestamp': firestore.SERVER_TIMESTAMP,
         'previous_balance': current_balance,
         'new_balance': new_balance
     })
     
     # Update customer debt and give bonus points
-    cust = db.collection('customers').where('name', '==', name).limit(1).stream()
-    for c in cust:
-        phone = c.id
-        cust_data = c.to_dict()
+    cust_ref = db.collection('customers').document(phone) if phone else None
+    cust_data = cust_ref.get(['current_debt', 'loyalty_points']).to_dict() if cust_ref else None
+    if cust_data is not None:
+        # Debt is clamped at zero and becomes the new baseline, so it stays absolute
         new_debt = max(0, cust_data.get('current_debt', 0) - amount)
         new_points = cust_data.get('loyalty_points', 0) + 5  # Bonus
         
-        db.collection('customers').document(phone).update({
+        batch.update(cust_ref, {
             'current_debt': new_debt,
-            'loyalty_points': new_points,
-            'last_debt_check': datetime.now(timezone.utc),
-            'debt_at_last_check': new_debt
+            'last_debt_check': firestore.SERVER_TIMESTAMP,
+            'debt_at_last_check': new_debt,
+            **tier_fields(new_points),
+            'loyalty_points': firestore.Increment(5)
         })
         
-        db.collection('point_history').add({
+        batch.set(db.collection('point_history').document(), {
             'customer_phone': phone,
             'change': 5,
             'reason': f'Payment: R{amount:.2f}',
-            'timestamp': datetime.now(timezone.utc)
+            'timestamp': firestore.SERVER_TIMESTAMP
         })
-        
-        update_customer_tier(db.collection('customers').document(phone), new_points)
+    batch.commit()
+    if phone:
+        invalidate_customer(phone)
+    
+    invalidate_cache(DASHBOARD_CACHE_KEY, DEBTORS_CACHE_KEY, REPORTS_CACHE_KEY)
     
     return jsonify({
         "status": "success",
@@ -657,6 +1172,7 @@ def update_goals():
         'daily': float(data.get('daily', 500)),
         'monthly': float(data.get('monthly', 15000))
     })
+    invalidate_cache(DASHBOARD_CACHE_KEY, GOALS_CACHE_KEY)
     return jsonify({"status": "success"})
 
 # Orders management
@@ -678,6 +1194,7 @@ def update_order_status():
     data = request.json
     order_id = data['order_id']
     status = data['status']  # approved, completed, rejected
+    now = request_now()  # only picks the daily rollup bucket
     
     order_ref = db.collection('orders').document(order_id)
     order = order_ref.get()
@@ -685,7 +1202,9 @@ def update_order_status():
         return jsonify({"status": "error", "message": "Order not found"}), 404
     
     order_data = order.to_dict()
-    order_ref.update({'status': status})
+    phone = None
+    batch = db.batch()
+    batch.update(order_ref, {'status': status})
     
     # If completed, create sale
     if status == 'completed':
@@ -694,32 +1213,36 @@ def update_order_status():
         method = order_data['payment_method']
         customer_name = order_data['customer_name']
         
-        db.collection('sales').add({
+        batch.set(db.collection('sales').document(), {
             'qty': total_sticks,
             'price': total_price,
             'method': method,
             'customer': customer_name,
-            'timestamp': datetime.now(timezone.utc),
+            'timestamp': firestore.SERVER_TIMESTAMP,
             'item_type': 'pack',
-            'from_order': order_id
+            'from_order': order_id,
+            'spending_counted': True
         })
+        add_sale_stats(batch, now.date(), total_price, total_sticks, method, 'pack',
+                       customer=customer_name)
         
         if method == 'credit':
+            phone = order_data['customer_phone']
             debtor_ref = db.collection('debtors').document(customer_name)
             if debtor_ref.get().exists:
-                debtor_ref.update({'balance': firestore.Increment(total_price)})
+                batch.update(debtor_ref, {'balance': firestore.Increment(total_price), 'customer_phone': phone})
             else:
-                debtor_ref.set({'balance': total_price, 'trust_score': 50, 'created': datetime.now(timezone.utc)})
+                batch.set(debtor_ref, {'balance': total_price, 'trust_score': DEFAULT_TRUST_SCORE,
+                                       'customer_phone': phone, 'created': firestore.SERVER_TIMESTAMP})
             
             # Update customer
-            phone = order_data['customer_phone']
             cust_ref = db.collection('customers').document(phone)
-            cust = cust_ref.get().to_dict()
-            new_debt = cust.get('current_debt', 0) + total_price
-            new_points = cust.get('loyalty_points', 0) + (total_sticks // 20)
-            
-            cust_ref.update({'current_debt': new_debt, 'loyalty_points': new_points})
-            update_customer_tier(cust_ref, new_points)
+            batch.update(cust_ref, customer_charge(cust_ref, total_price, total_sticks // 20))
+    batch.commit()
+    if phone:
+        invalidate_customer(phone)
+    
+    invalidate_cache(*SALES_CACHE_KEYS, DEBTORS_CACHE_KEY)
     
     return jsonify({"status": "success"})
 
@@ -727,14 +1250,13 @@ def update_order_status():
 @app.route('/customers')
 @login_required
 def view_customers():
-    customers = db.collection('customers').stream()
+    customers = db.collection('customers').order_by('loyalty_points', direction=firestore.Query.DESCENDING).stream()
     cust_list = []
     for c in customers:
         cd = c.to_dict()
         cd['phone'] = c.id
         cust_list.append(cd)
     
-    cust_list.sort(key=lambda x: x['loyalty_points'], reverse=True)
     return render_template('customers.html', customers=cust_list, user=session.get('user'), role=session.get('role'))
 
 @app.route('/customers/approve', methods=['POST'])
@@ -743,6 +1265,8 @@ def approve_customer():
     data = request.json
     phone = data['phone']
     db.collection('customers').document(phone).update({'approved': True})
+    invalidate_customer(phone)
+    invalidate_cache(DASHBOARD_CACHE_KEY)  # pending customer count
     return jsonify({"status": "success"})
 
 @app.route('/customers/toggle-credit', methods=['POST'])
@@ -752,6 +1276,7 @@ def toggle_credit():
     phone = data['phone']
     enabled = data['enabled']
     db.collection('customers').document(phone).update({'credit_enabled': enabled})
+    invalidate_customer(phone)
     return jsonify({"status": "success"})
 
 @app.route('/customers/update-limit', methods=['POST'])
@@ -761,6 +1286,7 @@ def update_credit_limit():
     phone = data['phone']
     limit = float(data['limit'])
     db.collection('customers').document(phone).update({'credit_limit': limit, 'tier_override': True})
+    invalidate_customer(phone)
     return jsonify({"status": "success"})
 
 @app.route('/customers/blacklist', methods=['POST'])
@@ -770,47 +1296,35 @@ def blacklist_customer():
     phone = data['phone']
     blacklisted = data['blacklisted']
     db.collection('customers').document(phone).update({'credit_enabled': not blacklisted})
+    invalidate_customer(phone)
     return jsonify({"status": "success"})
 
 # Insights page
 @app.route('/insights')
 @login_required
 def view_insights():
-    sales = list(db.collection('sales').stream())
-    customers_col = list(db.collection('customers').where('approved', '==', True).stream())
-    
-    # Top customers by spending
-    customer_spending = {}
-    for s in sales:
-        data = s.to_dict()
-        cust = data.get('customer', 'Cash Customer')
-        if cust not in customer_spending:
-            customer_spending[cust] = 0
-        customer_spending[cust] += data.get('price', 0)
+    # Copy each customer document once and reuse it for both rankings
+    cust_dicts = []
+    for c in stream_pages(db.collection('customers').where('approved', '==', True)):
+        cd = c.to_dict()
+        cd['phone'] = c.id
+        cust_dicts.append(cd)
     
-    top_customers = sorted(customer_spending.items(), key=lambda x: x[1], reverse=True)[:5]
+    # Top customers by spending, kept per customer in customer_spending
+    top_customers = get_top_spenders(5)
     
     # Most reliable payers (lowest debt ratio)
     reliable_payers = []
-    for c in customers_col:
-        cd = c.to_dict()
-        cd['phone'] = c.id
+    for cd in cust_dicts:
         if cd.get('loyalty_points', 0) > 0:
             debt_ratio = cd.get('current_debt', 0) / max(1, cd.get('loyalty_points', 1))
-            cd['debt_ratio'] = debt_ratio
-            reliable_payers.append(cd)
+            reliable_payers.append({**cd, 'debt_ratio': debt_ratio})
     
-    reliable_payers.sort(key=lambda x: x['debt_ratio'])
-    reliable_payers = reliable_payers[:5]
+    reliable_payers = heapq.nsmallest(5, reliable_payers, key=lambda x: x['debt_ratio'])
     
     # Worst debtors
-    worst_debtors = sorted(customers_col, key=lambda x: x.to_dict().get('current_debt', 0), reverse=True)[:5]
-    worst_debtor_list = []
-    for w in worst_debtors:
-        wd = w.to_dict()
-        wd['phone'] = w.id
-        if wd.get('current_debt', 0) > 0:
-            worst_debtor_list.append(wd)
+    worst_debtors = heapq.nlargest(5, cust_dicts, key=lambda x: x.get('current_debt', 0))
+    worst_debtor_list = [wd for wd in worst_debtors if wd.get('current_debt', 0) > 0]
     
     return render_template('insights.html',
                            top_customers=top_customers,
@@ -823,55 +1337,86 @@ def view_insights():
 @app.route('/debtors')
 @login_required
 def view_debtors():
-    debtors = db.collection('debtors').stream()
-    debtor_list = []
-    total_owed = 0
-    for d in debtors:
-        data = d.to_dict()
-        data['name'] = d.id
-        debtor_list.append(data)
-        total_owed += data['balance']
-    debtor_list.sort(key=lambda x: x['balance'], reverse=True)
+    # The table shows every debtor, so the header total is a sum over the
+    # (usually cached) list rather than another Firestore read
+    debtor_list = get_debtors()
+    total_owed = sum(d['balance'] for d in debtor_list)
     return render_template('debtors.html', debtors=debtor_list, total_owed=round(total_owed, 2), user=session.get('user'), role=session.get('role'))
 
 @app.route('/history')
 @login_required
 def view_history():
-    sales = db.collection('sales').order_by('timestamp', direction=firestore.Query.DESCENDING).limit(50).stream()
-    sales_list = []
-    for s in sales:
-        data = s.to_dict()
-        data['id'] = s.id
-        sales_list.append(data)
-    return render_template('history.html', sales=sales_list, user=session.get('user'), role=session.get('role'))
+    page_size = page_size_arg()
+    cursor = request.args.get('after')
+    
+    # The cursor is the last sale's ID; paging resumes from its snapshot, so
+    # sales sharing a timestamp are never skipped or repeated
+    query = db.collection('sales').select(SALE_LIST_FIELDS).order_by('timestamp', direction=firestore.Query.DESCENDING).limit(page_size)
+    if cursor:
+        cursor_doc = db.collection('sales').document(cursor).get(['timestamp'])
+        if cursor_doc.exists:
+            query = query.start_after(cursor_doc)
+        else:
+            cursor = None
+    
+    # The default first page is what nearly every visit asks for, so it is cached
+    cacheable = not cursor and page_size == HISTORY_PAGE_SIZE
+    sales_list = cache_get(HISTORY_CACHE_KEY) if cacheable else None
+    if sales_list is None:
+        sales_list = []
+        for s in query.stream():
+            data = s.to_dict()
+            data['id'] = s.id
+            data['profit'] = data['price'] - (data['qty'] * COST_PER_STICK)
+            sales_list.append(data)
+        if cacheable:
+            cache_set(HISTORY_CACHE_KEY, sales_list, PAGE_CACHE_TTL)
+    
+    next_cursor = sales_list[-1]['id'] if len(sales_list) == page_size else None
+    return render_template('history.html', sales=sales_list, cursor=cursor, next_cursor=next_cursor, page_size=page_size, user=session.get('user'), role=session.get('role'))
 
-@app.route('/stock')
-@login_required
-def view_stock():
-    stock_docs = db.collection('stock').order_by('date', direction=firestore.Query.DESCENDING).stream()
-    stock_list = []
-    total_bundles = 0
-    total_spent = 0
-    total_sticks_from_stock = 0
-    for doc in stock_docs:
+@lru_cache(maxsize=256)
+def month_label(year, month):
+    """'March 2025'-style heading for a stock month"""
+    return datetime(year, month, 1).strftime('%B %Y')
+
+def compute_stock_stats():
+    """Template values for the stock page"""
+    stock_query = db.collection('stock').select(['bundles', 'sticks', 'cost', 'date', 'note']).order_by('date', direction=firestore.Query.DESCENDING)
+    f_totals = EXECUTOR.submit(get_global_stats)
+    
+    # Single streaming pass for the monthly grouping; totals come from stats/global
+    monthly = {}
+    for doc in stock_query.stream():
         data = doc.to_dict()
         data['id'] = doc.id
-        stock_list.append(data)
-        total_bundles += data['bundles']
-        total_spent += data['cost']
-        total_sticks_from_stock += data['bundles'] * STICKS_PER_BUNDLE
-    monthly = {}
-    for s in stock_list:
-        month_key = s['date'].strftime('%B %Y')
-        if month_key not in monthly:
-            monthly[month_key] = {'bundles': 0, 'cost': 0.0, 'entries': []}
-        monthly[month_key]['bundles'] += s['bundles']
-        monthly[month_key]['cost'] += s['cost']
-        monthly[month_key]['entries'].append(s)
-    sales = db.collection('sales').stream()
-    total_sticks_sold = sum(s.to_dict()['qty'] for s in sales)
+        month = monthly.setdefault(month_label(data['date'].year, data['date'].month), {'bundles': 0, 'cost': 0.0, 'entries': []})
+        month['bundles'] += data['bundles']
+        month['cost'] += data['cost']
+        month['entries'].append(data)
+    totals = f_totals.result()
+    total_bundles = totals.get('stock_bundles', 0)
+    total_spent = totals.get('stock_cost', 0)
+    total_sticks_from_stock = totals.get('stock_sticks', 0)
+    total_sticks_sold = totals.get('sticks', 0)
     sticks_remaining = total_sticks_from_stock - total_sticks_sold
-    return render_template('stock.html', stock_list=stock_list, monthly=monthly, total_bundles=total_bundles, total_spent=total_spent, total_sticks_from_stock=total_sticks_from_stock, total_sticks_sold=total_sticks_sold, sticks_remaining=sticks_remaining, bundle_cost=BUNDLE_COST, sticks_per_bundle=STICKS_PER_BUNDLE, user=session.get('user'), role=session.get('role'))
+    return dict(monthly=monthly,
+                total_bundles=total_bundles,
+                total_spent=total_spent,
+                total_sticks_from_stock=total_sticks_from_stock,
+                total_sticks_sold=total_sticks_sold,
+                sticks_remaining=sticks_remaining,
+                bundle_cost=BUNDLE_COST,
+                sticks_per_bundle=STICKS_PER_BUNDLE)
+
+@app.route('/stock')
+@login_required
+def view_stock():
+    stats = cache_get(STOCK_CACHE_KEY)
+    if stats is None:
+        stats = compute_stock_stats()
+        cache_set(STOCK_CACHE_KEY, stats, PAGE_CACHE_TTL)
+    return render_template('stock.html', **stats, user=session.get('user'), role=session.get('role'))
 
 @app.route('/stock/add', methods=['POST'])
 @login_required
@@ -886,14 +1431,23 @@ def add_stock():
     transport_source = data.get('transport_source', 'personal')  # who paid transport
     
     if data.get('date'):
-        purchase_date = datetime.strptime(data['date'], '%Y-%m-%d').replace(tzinfo=timezone.utc)
+        purchase_date = datetime.fromisoformat(data['date']).replace(tzinfo=timezone.utc)
     else:
-        purchase_date = datetime.now(timezone.utc)
+        purchase_date = firestore.SERVER_TIMESTAMP
+    
+    # Everything is staged on one batch; IDs are generated client-side so the
+    # stock entry can list its bundles. Only purchases too big for one batch
+    # are committed in chunks
+    batch = db.batch()
     
     # Create individual bundle records
     bundle_ids = []
     for i in range(bundles):
-        bundle_doc = db.collection('bundles').add({
+        if len(batch) >= BATCH_LIMIT:
+            batch.commit()
+            batch = db.batch()
+        bundle_ref = db.collection('bundles').document()
+        bundle = {
             'bundle_number': i + 1,
             'purchase_date': purchase_date,
             'cost': BUNDLE_COST,
@@ -903,11 +1457,16 @@ def add_stock():
             'credit_revenue': 0,
             'status': 'active',
             'note': data.get('note', '')
-        })
-        bundle_ids.append(bundle_doc[1].id)
+        }
+        bundle.update(bundle_figures(bundle))
+        batch.set(bundle_ref, bundle)
+        bundle_ids.append(bundle_ref.id)
+    if len(batch) > BATCH_LIMIT - 5:
+        batch.commit()
+        batch = db.batch()
     
     # Add to stock collection (for backwards compatibility)
-    db.collection('stock').add({
+    batch.set(db.collection('stock').document(), {
         'bundles': bundles,
         'sticks': bundles * STICKS_PER_BUNDLE,
         'cost': stock_cost,
@@ -921,7 +1480,7 @@ def add_stock():
     
     # Record expenses if paid from business cash
     if payment_source == 'business':
-        db.collection('expenses').add({
+        batch.set(db.collection('expenses').document(), {
             'type': 'stock',
             'amount': stock_cost,
             'description': f'{bundles} bundles purchased',
@@ -930,7 +1489,7 @@ def add_stock():
         })
     
     if transport_cost > 0 and transport_source == 'business':
-        db.collection('expenses').add({
+        batch.set(db.collection('expenses').document(), {
             'type': 'transport',
             'amount': transport_cost,
             'description': f'Transport for {bundles} bundles',
@@ -940,19 +1499,35 @@ def add_stock():
     
     # Record personal injection if paid from personal money
     if payment_source == 'personal':
-        db.collection('personal_injections').add({
+        batch.set(db.collection('personal_injections').document(), {
             'amount': stock_cost,
             'description': f'Personal money for {bundles} bundles',
             'date': purchase_date
         })
     
     if transport_cost > 0 and transport_source == 'personal':
-        db.collection('personal_injections').add({
+        batch.set(db.collection('personal_injections').document(), {
             'amount': transport_cost,
             'description': f'Personal money for transport',
             'date': purchase_date
         })
     
+    # Running totals for the stock, dashboard and reports pages
+    paid_by = {'business': 0, 'personal': 0}
+    paid_by[payment_source] = paid_by.get(payment_source, 0) + stock_cost
+    if transport_cost > 0:
+        paid_by[transport_source] = paid_by.get(transport_source, 0) + transport_cost
+    batch.set(db.collection('stats').document('global'), {
+        'stock_bundles': firestore.Increment(bundles),
+        'stock_sticks': firestore.Increment(bundles * STICKS_PER_BUNDLE),
+        'stock_cost': firestore.Increment(stock_cost),
+        'expenses_total': firestore.Increment(paid_by['business']),
+        'injections_total': firestore.Increment(paid_by['personal'])
+    }, merge=True)
+    batch.commit()
+    
+    invalidate_cache(DASHBOARD_CACHE_KEY, STOCK_CACHE_KEY, REPORTS_CACHE_KEY)
+    
     return jsonify({
         "status": "success",
         "bundles": bundles,
@@ -966,7 +1541,19 @@ def add_stock():
 def delete_stock():
     data = request.json
     try:
-        db.collection('stock').document(data['stock_id']).delete()
+        stock_ref = db.collection('stock').document(data['stock_id'])
+        stock_doc = stock_ref.get(['bundles', 'sticks', 'cost'])
+        batch = db.batch()
+        batch.delete(stock_ref)
+        if stock_doc.exists:
+            entry = stock_doc.to_dict()
+            batch.set(db.collection('stats').document('global'), {
+                'stock_bundles': firestore.Increment(-entry.get('bundles', 0)),
+                'stock_sticks': firestore.Increment(-entry.get('sticks', 0)),
+                'stock_cost': firestore.Increment(-entry.get('cost', 0))
+            }, merge=True)
+        batch.commit()
+        invalidate_cache(DASHBOARD_CACHE_KEY, STOCK_CACHE_KEY)
         return jsonify({"status": "success", "message": "Stock entry deleted"})
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
@@ -975,11 +1562,16 @@ def delete_stock():
 @login_required
 def recent_transactions():
     try:
-        sales = db.collection('sales').order_by('timestamp', direction=firestore.Query.DESCENDING).limit(10).stream()
+        # Sales are cached; time_ago is still worked out fresh on each call
+        sales = cache_get(RECENT_SALES_CACHE_KEY)
+        if sales is None:
+            query = db.collection('sales').select(SALE_LIST_FIELDS).order_by('timestamp', direction=firestore.Query.DESCENDING).limit(10)
+            sales = [dict(s.to_dict(), id=s.id) for s in query.stream()]
+            cache_set(RECENT_SALES_CACHE_KEY, sales, PAGE_CACHE_TTL)
         transactions = []
-        now = datetime.now(timezone.utc)
-        for s in sales:
-            data = s.to_dict()
+        now_ts = request_now().timestamp()
+        cost_per_stick = COST_PER_STICK
+        for data in sales:
             if 'price' not in data or 'qty' not in data:
                 continue
             ts = data.get('timestamp')
@@ -988,29 +1580,27 @@ def recent_transactions():
             else:
                 if ts.tzinfo is None:
                     ts = ts.replace(tzinfo=timezone.utc)
-                total_seconds = int((now - ts).total_seconds())
-                if total_seconds < 60:
-                    time_ago = "Just now"
-                elif total_seconds < 3600:
-                    time_ago = f"{total_seconds // 60} min ago"
-                elif total_seconds < 86400:
-                    h = total_seconds // 3600
-                    time_ago = f"{h} hour{'s' if h > 1 else ''} ago"
-                else:
-                    d = (now - ts).days
-                    time_ago = f"{d} day{'s' if d > 1 else ''} ago"
-            profit = data['price'] - (data['qty'] * COST_PER_STICK)
-            transactions.append({'id': s.id, 'customer': data.get('customer', 'Unknown'), 'method': data.get('method', 'cash'), 'item_type': data.get('item_type', 'pack'), 'price': data['price'], 'qty': data['qty'], 'profit': round(profit, 2), 'time_ago': time_ago})
+                time_ago = humanize_age(int(now_ts - ts.timestamp()))
+            profit = data['price'] - (data['qty'] * cost_per_stick)
+            transactions.append({'id': data['id'], 'customer': data.get('customer', 'Unknown'), 'method': data.get('method', 'cash'), 'item_type': data.get('item_type', 'pack'), 'price': data['price'], 'qty': data['qty'], 'profit': round(profit, 2), 'time_ago': time_ago})
         return jsonify({'transactions': transactions})
     except Exception as e:
         print(f"ERROR in recent_transactions: {e}")
         return jsonify({'transactions': [], 'error': str(e)}), 500
 
-@app.route('/reports')
-@login_required
-def view_reports():
-    """Summary reports page with bundles tab"""
-    now = datetime.now(timezone.utc)
+def bundle_figures(bundle):
+    """Derived revenue, profit and sell-through for a bundle document.
+    Stored alongside the raw counters so reports can render them as-is"""
+    total_revenue = bundle['cash_revenue'] + bundle['credit_revenue']
+    return {
+        'total_revenue': round(total_revenue, 2),
+        'profit': round(total_revenue - bundle['cost'], 2),
+        'progress_pct': round((bundle['sticks_sold'] / bundle['sticks_total']) * 100, 1),
+    }
+
+def compute_report_stats():
+    """Template values for the reports page"""
+    now = request_now()
     today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
     yesterday_start = today_start - timedelta(days=1)
     week_start = today_start - timedelta(days=today_start.weekday())
@@ -1021,9 +1611,31 @@ def view_reports():
     else:
         last_month_start = month_start.replace(month=month_start.month - 1)
     
-    def get_period_data(start, end):
-        sales = db.collection('sales').where('timestamp', '>=', start).where('timestamp', '<', end).stream()
-        payments = db.collection('payments').where('timestamp', '>=', start).where('timestamp', '<', end).stream()
+    def fetch_window(collection, fields, start, end):
+        query = db.collection(collection).select(fields).where('timestamp', '>=', start).where('timestamp', '<', end)
+        return EXECUTOR.submit(lambda: list(query.stream()))
+    
+    # Every period's sales and payments query goes out at once; get_period_data
+    # then only waits on its own pair
+    windows = {
+        'today': (today_start, now),
+        'yesterday': (yesterday_start, today_start),
+        'this_week': (week_start, now),
+        'last_week': (last_week_start, week_start),
+        'this_month': (month_start, now),
+        'last_month': (last_month_start, month_start),
+    }
+    fetched = {name: (fetch_window('sales', ['price', 'qty', 'method', 'customer'], start, end),
+                      fetch_window('payments', ['amount'], start, end))
+               for name, (start, end) in windows.items()}
+    bundles_query = db.collection('bundles').order_by('purchase_date', direction=firestore.Query.DESCENDING).limit(REPORT_BUNDLE_LIMIT)
+    f_bundles = EXECUTOR.submit(lambda: list(bundles_query.stream()))
+    f_totals = EXECUTOR.submit(get_global_stats)
+    
+    def get_period_data(name):
+        sales_future, payments_future = fetched[name]
+        sales = sales_future.result()
+        payments = payments_future.result()
         
         total_sales = 0
         total_sticks = 0
@@ -1065,12 +1677,12 @@ def view_reports():
             'top_customer_amount': round(top_customer[1], 2)
         }
     
-    today = get_period_data(today_start, now)
-    yesterday = get_period_data(yesterday_start, today_start)
-    this_week = get_period_data(week_start, now)
-    last_week = get_period_data(last_week_start, week_start)
-    this_month = get_period_data(month_start, now)
-    last_month = get_period_data(last_month_start, month_start)
+    today = get_period_data('today')
+    yesterday = get_period_data('yesterday')
+    this_week = get_period_data('this_week')
+    last_week = get_period_data('last_week')
+    this_month = get_period_data('this_month')
+    last_month = get_period_data('last_month')
     
     def calc_change(current, previous):
         if previous == 0:
@@ -1081,88 +1693,105 @@ def view_reports():
     month_change = calc_change(this_month['total_sales'], last_month['total_sales'])
     
     # Bundle data
-    bundles = db.collection('bundles').order_by('purchase_date', direction=firestore.Query.DESCENDING).stream()
+    bundles = f_bundles.result()
     bundle_list = []
-    bundle_chart_labels = []
-    bundle_chart_cash = []
-    bundle_chart_credit = []
-    
-    for idx, b in enumerate(bundles):
+    for b in bundles:
         bd = b.to_dict()
         bd['id'] = b.id
         
-        total_revenue = bd['cash_revenue'] + bd['credit_revenue']
-        profit = total_revenue - bd['cost']
-        progress_pct = (bd['sticks_sold'] / bd['sticks_total']) * 100
-        
-        bd['total_revenue'] = round(total_revenue, 2)
-        bd['profit'] = round(profit, 2)
-        bd['progress_pct'] = round(progress_pct, 1)
+        # Figures are stored on the bundle when it is written; only bundles
+        # created before that need them worked out here
+        if 'progress_pct' not in bd:
+            bd.update(bundle_figures(bd))
         
         bundle_list.append(bd)
-        
-        # Chart data (last 20 bundles)
-        if idx < 20:
-            bundle_chart_labels.insert(0, f"Bundle {idx + 1}")
-            bundle_chart_cash.insert(0, round(bd['cash_revenue'], 2))
-            bundle_chart_credit.insert(0, round(bd['credit_revenue'], 2))
     
-    # Calculate cash flow
-    sales_all = db.collection('sales').stream()
-    total_cash_sales = sum(s.to_dict()['price'] for s in sales_all if s.to_dict().get('method') == 'cash')
+    # Chart the newest bundles, reading oldest to newest
+    charted = bundle_list[:BUNDLE_CHART_SIZE][::-1]
+    bundle_chart_labels = [f"Bundle {n}" for n in range(len(charted), 0, -1)]
+    bundle_chart_cash = [round(bd['cash_revenue'], 2) for bd in charted]
+    bundle_chart_credit = [round(bd['credit_revenue'], 2) for bd in charted]
     
-    expenses_all = db.collection('expenses').stream()
-    total_expenses = sum(e.to_dict().get('amount', 0) for e in expenses_all)
-    
-    injections_all = db.collection('personal_injections').stream()
-    total_injections = sum(i.to_dict().get('amount', 0) for i in injections_all)
+    # Calculate cash flow; lifetime cash sales come from the rollup document
+    totals = f_totals.result()
+    total_cash_sales = totals.get('cash', 0)
+    total_expenses = totals.get('expenses_total', 0)
+    total_injections = totals.get('injections_total', 0)
     
     net_cash = total_cash_sales + total_injections - total_expenses
     
-    return render_template('reports.html',
-                           today=today,
-                           yesterday=yesterday,
-                           this_week=this_week,
-                           last_week=last_week,
-                           this_month=this_month,
-                           last_month=last_month,
-                           week_change=week_change,
-                           month_change=month_change,
-                           bundles=bundle_list,
-                           bundle_chart_labels=bundle_chart_labels,
-                           bundle_chart_cash=bundle_chart_cash,
-                           bundle_chart_credit=bundle_chart_credit,
-                           total_cash_sales=round(total_cash_sales, 2),
-                           total_expenses=round(total_expenses, 2),
-                           total_injections=round(total_injections, 2),
-                           net_cash=round(net_cash, 2),
-                           user=session.get('user'),
-                           role=session.get('role'))
+    return dict(today=today,
+                yesterday=yesterday,
+                this_week=this_week,
+                last_week=last_week,
+                this_month=this_month,
+                last_month=last_month,
+                week_change=week_change,
+                month_change=month_change,
+                bundles=bundle_list,
+                bundle_chart_labels=bundle_chart_labels,
+                bundle_chart_cash=bundle_chart_cash,
+                bundle_chart_credit=bundle_chart_credit,
+                total_cash_sales=round(total_cash_sales, 2),
+                total_expenses=round(total_expenses, 2),
+                total_injections=round(total_injections, 2),
+                net_cash=round(net_cash, 2))
+
+@app.route('/reports')
+@login_required
+def view_reports():
+    """Summary reports page with bundles tab"""
+    stats = cache_get(REPORTS_CACHE_KEY)
+    if stats is None:
+        stats = compute_report_stats()
+        cache_set(REPORTS_CACHE_KEY, stats, PAGE_CACHE_TTL)
+    return render_template('reports.html', **stats, user=session.get('user'), role=session.get('role'))
+
+@firestore.transactional
+def delete_sale(transaction, sale_ref):
+    """Delete a sale, reversing its rollups and any credit it added, atomically.
+    Returns False if the sale no longer exists. A retry re-reads both
+    documents, so concurrent deletes can't reverse the same sale twice."""
+    doc = sale_ref.get(transaction=transaction)
+    if not doc.exists:
+        return False
+    trans_data = doc.to_dict()
+    ts = trans_data.get('timestamp')
+    if ts and ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    
+    # All reads happen before the first write, as transactions require
+    debtor_ref = debtor_doc = None
+    if trans_data['method'] == 'credit':
+        debtor_ref = db.collection('debtors').document(trans_data['customer'])
+        debtor_doc = debtor_ref.get(['balance'], transaction=transaction)
+    
+    transaction.delete(sale_ref)
+    if debtor_doc is not None and debtor_doc.exists:
+        current_balance = debtor_doc.get('balance')
+        new_balance = max(0, current_balance - trans_data['price'])
+        if new_balance == 0:
+            transaction.delete(debtor_ref)
+        else:
+            transaction.update(debtor_ref, {'balance': new_balance})
+    add_sale_stats(transaction, ts.date() if ts else None, trans_data.get('price', 0), trans_data.get('qty', 0),
+                   trans_data.get('method', 'cash'), trans_data.get('item_type', 'pack'), sign=-1,
+                   customer=trans_data.get('customer', 'Cash Customer') if trans_data.get('spending_counted') else None)
+    return True
 
 @app.route('/delete-transaction', methods=['POST'])
 @login_required
 def delete_transaction():
     data = request.json
     try:
-        doc = db.collection('sales').document(data['transaction_id']).get()
-        if not doc.exists:
+        sale_ref = db.collection('sales').document(data['transaction_id'])
+        if not delete_sale(db.transaction(), sale_ref):
             return jsonify({"status": "error", "message": "Transaction not found"}), 404
-        trans_data = doc.to_dict()
-        if trans_data['method'] == 'credit':
-            customer_name = trans_data['customer']
-            amount = trans_data['price']
-            debtor_ref = db.collection('debtors').document(customer_name)
-            debtor_doc = debtor_ref.get()
-            if debtor_doc.exists:
-                new_balance = max(0, debtor_doc.to_dict()['balance'] - amount)
-                if new_balance == 0:
-                    debtor_ref.delete()
-                else:
-                    debtor_ref.update({'balance': new_balance})
-        db.collection('sales').document(data['transaction_id']).delete()
+        invalidate_cache(*SALES_CACHE_KEYS, DEBTORS_CACHE_KEY)
         return jsonify({"status": "success", "message": "Transaction deleted"})
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    # Local development only; production runs under gunicorn (see Dockerfile)
+    app.run(debug=os.environ.get("FLASK_DEBUG") == "1", host='0.0.0.0', port=5000, threaded=True)
\ No newline at end of file